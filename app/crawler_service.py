@@ -0,0 +1,532 @@
+"""
+Runs the PMC crawler as a long-lived local HTTP service.
+
+Rather than starting a fresh papermill kernel for every report, the service
+executes the crawler notebook in-process, injecting its parameters the same way
+papermill does. It also injects itself as the notebook's `crawler_service`
+parameter, which the notebook uses to reuse the author roster, the NCBI request
+cache, fetched CSL items and the parsed CSL style between jobs, and to share
+(search term, month) NCBI searches across jobs, including ones running at the
+same time.
+
+Endpoints:
+  POST /jobs                      queue a report; the body is a JSON object of
+                                  notebook parameters, e.g. {"start_date": "2024/01/01",
+                                  "end_date": "2024/01/31", "department": "..."}
+  GET  /jobs                      list all jobs
+  GET  /jobs/<id>                 a job's status and artifacts
+  GET  /jobs/<id>/events          stream a job's progress as server-sent events
+  GET  /jobs/<id>/files/<name>    download an artifact from the job's BUILD_FOLDER
+"""
+import copy
+import json
+import logging
+import mimetypes
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+from urllib.parse import unquote, urlparse
+
+import nbformat
+import requests_cache
+from citeproc import CitationStylesStyle
+from ratelimit import limits, sleep_and_retry
+
+log = logging.getLogger(__name__)
+
+NOTEBOOKS_FOLDER = os.environ.get("NOTEBOOKS_FOLDER", "/app/notebooks")
+TARGET_NOTEBOOK = os.environ.get("TARGET_NOTEBOOK", "Create Cites from PMC Lookups - Monthly.ipynb")
+BUILD_FOLDER_PREFIX = os.environ.get("BUILD_FOLDER_PREFIX", "/app/_build")
+
+SERVICE_PORT = int(os.environ.get("CRAWLER_SERVICE_PORT", 8080))
+# how many jobs may run at once; NCBI calls are still made one at a time
+SERVICE_WORKERS = int(os.environ.get("CRAWLER_SERVICE_WORKERS", 2))
+# how long, in seconds, the roster, searches and CSL items are reused before being fetched again
+SERVICE_CACHE_TTL = int(os.environ.get("CRAWLER_SERVICE_CACHE_TTL", 6 * 60 * 60))
+# how many finished or failed jobs are remembered, oldest first to be forgotten
+SERVICE_JOB_HISTORY = int(os.environ.get("CRAWLER_SERVICE_JOB_HISTORY", 100))
+
+# the parameters a job may set, matching the notebook's parameters cell
+JOB_PARAMETERS = [
+    "start_date",
+    "end_date",
+    "authors_sheet_id",
+    "authors_sheet_path",
+    "department",
+    "department_name",
+]
+
+# same limits as the notebook, but shared by every job in the service
+NCBI_RATE_LIMIT = 10 if os.environ.get("NCBI_API_KEY") else 3
+NCBI_CALL_PERIOD = 3
+
+
+@sleep_and_retry
+@limits(calls=NCBI_RATE_LIMIT, period=NCBI_CALL_PERIOD)
+def ncbi_rate_limit():
+    """
+    Blocks until another call to NCBI is allowed.
+    """
+
+
+def month_windows(mindate: str, maxdate: str) -> List[tuple]:
+    """
+    Splits the inclusive yyyy/mm/dd window into (mindate, maxdate) windows
+    that each fall within a single calendar month.
+    """
+    date_format_string = "%Y/%m/%d"
+
+    window_start = datetime.strptime(mindate, date_format_string)
+    window_end = datetime.strptime(maxdate, date_format_string)
+
+    windows = []
+    while window_start <= window_end:
+        next_month = (window_start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        month_end = min(next_month - timedelta(days=1), window_end)
+        windows.append((window_start.strftime(date_format_string), month_end.strftime(date_format_string)))
+        window_start = next_month
+
+    return windows
+
+
+class CrawlerService:
+    """
+    The in-memory state shared by every job, and the queue of jobs to run.
+
+    An instance is injected into the notebook as `crawler_service`.
+    """
+
+    def __init__(
+        self,
+        workers: int = SERVICE_WORKERS,
+        cache_ttl: int = SERVICE_CACHE_TTL,
+        job_history: int = SERVICE_JOB_HISTORY,
+    ):
+        self.cache_ttl = cache_ttl
+        self.job_history = job_history
+        self.jobs: Dict[str, "Job"] = {}
+
+        self._queue = queue.Queue()
+        self._workers = workers
+        self._lock = threading.Lock()
+        # NCBI asks that we don't make requests in parallel, so jobs take turns
+        self._ncbi_lock = threading.Lock()
+
+        # key -> (created time, Future) for rosters, styles and searches
+        self._shared = {}
+        # "pubmed:<id>" -> (created time, CSL item)
+        self._csl_items = {}
+        self._session = None
+
+    def start(self):
+        for _ in range(self._workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    # --------------------------------------------------------------------------
+    # --- state used by the notebook
+    # --------------------------------------------------------------------------
+
+    @property
+    def session(self) -> requests_cache.CachedSession:
+        with self._lock:
+            if self._session is None:
+                self._session = requests_cache.CachedSession('ncbi_authors_cache')
+            return self._session
+
+    def _get_shared(self, key, compute: Callable, keep: Callable = None):
+        """
+        Returns the result of compute(), shared with every other caller using
+        the same key until cache_ttl expires. Callers that arrive while another
+        is computing the result wait for it rather than computing it again.
+
+        Results for which keep(result) is false aren't reused.
+        """
+        with self._lock:
+            created, future = self._shared.get(key, (None, None))
+            owner = future is None or time.monotonic() - created > self.cache_ttl
+            if owner:
+                self._sweep_shared()
+                future = Future()
+                self._shared[key] = (time.monotonic(), future)
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = compute()
+        except Exception as ex:
+            with self._lock:
+                self._shared.pop(key, None)
+            future.set_exception(ex)
+            raise
+
+        if keep is not None and not keep(result):
+            with self._lock:
+                self._shared.pop(key, None)
+
+        future.set_result(result)
+        return result
+
+    def _sweep_shared(self):
+        """
+        Forgets expired results, so they don't stay in memory until their key
+        happens to be asked for again. Must be called with self._lock held.
+        """
+        now = time.monotonic()
+        expired = [
+            key for key, (created, future) in self._shared.items()
+            if future.done() and now - created > self.cache_ttl
+        ]
+        for key in expired:
+            del self._shared[key]
+
+    def roster(self, load_authors_df: Callable, authors_sheet_path: str, authors_sheet_id):
+        """
+        Returns the authors dataframe, loading it with load_authors_df() only if
+        it's not already in memory or the local spreadsheet has changed.
+        """
+        if authors_sheet_path is not None and authors_sheet_path.strip() != "":
+            key = ("roster", authors_sheet_path, os.path.getmtime(authors_sheet_path))
+        else:
+            key = ("roster", str(authors_sheet_id))
+
+        return self._get_shared(key, lambda: load_authors_df(authors_sheet_path, authors_sheet_id))
+
+    def style(self, path: str) -> CitationStylesStyle:
+        """
+        Returns the parsed CSL style at path, parsing it again only if it's changed.
+        """
+        key = ("style", os.path.abspath(path), os.path.getmtime(path))
+
+        return self._get_shared(key, lambda: CitationStylesStyle(path))
+
+    def coalesced_search(self, search_ncbi: Callable) -> Callable:
+        """
+        Wraps the notebook's search_ncbi() so that each search is made one month
+        at a time, and each (search term, month) result is shared with every job
+        that asks for it.
+        """
+
+        def search(term: str, mindate: str, maxdate: str, **kwargs):
+            status_code, ids = 200, []
+
+            for window_start, window_end in month_windows(mindate, maxdate):
+                key = ("search", term, window_start, window_end, tuple(sorted(kwargs.items())))
+
+                window_status_code, window_ids = self._get_shared(
+                    key,
+                    lambda: self.call_ncbi(search_ncbi, term=term, mindate=window_start, maxdate=window_end, **kwargs),
+                    # don't hold on to partial results from failed searches
+                    keep=lambda result: result[0] == 200,
+                )
+
+                if window_status_code != 200:
+                    status_code = window_status_code
+                ids = list(dict.fromkeys(ids + window_ids))
+
+            return status_code, ids
+
+        return search
+
+    def csl_items(self, ids: List[str], fetch: Callable) -> List[dict]:
+        """
+        Returns the CSL items for ids (as "pubmed:<id>"), calling fetch() for just
+        the ones that aren't in memory.
+
+        The items are copies, so the notebook can modify them.
+        """
+        with self._ncbi_lock:
+            now = time.monotonic()
+
+            # forget every expired item, not just the ones asked for here
+            self._csl_items = {
+                id: (created, item) for id, (created, item) in self._csl_items.items()
+                if now - created <= self.cache_ttl
+            }
+
+            missing = [id for id in ids if id not in self._csl_items]
+
+            if missing:
+                log.info(f"Fetching {len(missing)}/{len(ids)} CSL items not already in memory")
+                for item in fetch(missing):
+                    self._csl_items[f"pubmed:{item['PMID']}"] = (now, item)
+
+            return [copy.deepcopy(self._csl_items[id][1]) for id in ids if id in self._csl_items]
+
+    def call_ncbi(self, fn: Callable, **kwargs):
+        """
+        Calls fn(**kwargs), which makes a request to NCBI, once it's this job's
+        turn and the shared rate limit allows.
+        """
+        with self._ncbi_lock:
+            ncbi_rate_limit()
+            return fn(**kwargs)
+
+    # --------------------------------------------------------------------------
+    # --- jobs
+    # --------------------------------------------------------------------------
+
+    def submit(self, params: dict) -> "Job":
+        """
+        Queues a job with the given notebook parameters, or returns the job
+        that's already queued or running with the same parameters.
+
+        Like run_crawl.sh, a missing start_date or end_date defaults to the
+        first or last day of the current month.
+
+        Raises ValueError if the parameters aren't valid.
+        """
+        if not isinstance(params, dict):
+            raise ValueError("Expected a JSON object of parameters")
+
+        unknown = set(params) - set(JOB_PARAMETERS)
+        if unknown:
+            raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+
+        date_format_string = "%Y/%m/%d"
+        first_of_month = datetime.today().replace(day=1)
+        last_of_month = (first_of_month + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+        params = dict(params)
+        params["start_date"] = params.get("start_date") or first_of_month.strftime(date_format_string)
+        params["end_date"] = params.get("end_date") or last_of_month.strftime(date_format_string)
+
+        try:
+            start_date = datetime.strptime(params["start_date"], date_format_string)
+            end_date = datetime.strptime(params["end_date"], date_format_string)
+        except (TypeError, ValueError):
+            raise ValueError("start_date and end_date must be given as yyyy/mm/dd")
+
+        if start_date > end_date:
+            raise ValueError("start_date must not be after end_date")
+
+        with self._lock:
+            for job in self.jobs.values():
+                if job.params == params and job.status in ("queued", "running"):
+                    return job
+
+            job = Job(params)
+            self.jobs[job.id] = job
+            self._forget_old_jobs()
+
+        job.emit("queued")
+        self._queue.put(job)
+        return job
+
+    def list_jobs(self) -> List["Job"]:
+        with self._lock:
+            return list(self.jobs.values())
+
+    def get_job(self, id: str) -> "Job":
+        with self._lock:
+            return self.jobs.get(id)
+
+    def _forget_old_jobs(self):
+        """
+        Forgets the oldest finished or failed jobs beyond job_history, along
+        with their events. Their files are left in BUILD_FOLDER_PREFIX.
+        Must be called with self._lock held.
+        """
+        done = [id for id, job in self.jobs.items() if job.status in ("finished", "failed")]
+        for id in done[:max(len(done) - self.job_history, 0)]:
+            del self.jobs[id]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job: "Job"):
+        """
+        Executes the notebook's code cells in a fresh namespace, injecting the
+        job's parameters after the parameters cell like papermill does.
+        """
+        job.status = "running"
+        job.emit("started")
+
+        notebook = nbformat.read(os.path.join(NOTEBOOKS_FOLDER, TARGET_NOTEBOOK), as_version=4)
+        cells = [cell for cell in notebook.cells if cell.cell_type == "code"]
+
+        injected = dict(job.params)
+        injected["crawler_service"] = self
+        # keep each job's artifacts apart, so that concurrent jobs for the same dates don't collide
+        injected["BUILD_FOLDER_PREFIX"] = os.path.join(BUILD_FOLDER_PREFIX, "jobs", job.id)
+
+        namespace = {"__name__": "__main__"}
+
+        try:
+            for index, cell in enumerate(cells):
+                job.emit("cell", index=index + 1, total=len(cells), source=cell.source.split("\n")[0])
+                exec(compile(cell.source, f"<{TARGET_NOTEBOOK} cell {index + 1}>", "exec"), namespace)
+
+                if "parameters" in cell.metadata.get("tags", []):
+                    namespace.update(injected)
+
+            job.build_folder = namespace.get("BUILD_FOLDER")
+            job.status = "finished"
+            job.emit("finished", artifacts=job.artifacts())
+        except Exception as ex:
+            log.exception(f"Job {job.id} failed")
+            job.status = "failed"
+            job.error = "".join(traceback.format_exception_only(type(ex), ex)).strip()
+            job.emit("failed", error=job.error)
+
+
+class Job:
+    """
+    A report request and the progress events it has produced so far.
+    """
+
+    def __init__(self, params: dict):
+        self.id = uuid.uuid4().hex[:12]
+        self.params = params
+        self.status = "queued"
+        self.error = None
+        self.build_folder = None
+        self.events = []
+        self._changed = threading.Condition()
+
+    def emit(self, event: str, **data):
+        with self._changed:
+            self.events.append({"event": event, "time": datetime.now().isoformat(timespec="seconds"), **data})
+            self._changed.notify_all()
+
+    def follow(self):
+        """
+        Yields every event, waiting for new ones until the job finishes or fails.
+        """
+        index = 0
+        while True:
+            with self._changed:
+                while index >= len(self.events):
+                    self._changed.wait()
+                event = self.events[index]
+            index += 1
+
+            yield event
+
+            if event["event"] in ("finished", "failed"):
+                return
+
+    def artifacts(self) -> List[str]:
+        if self.build_folder is None or not os.path.isdir(self.build_folder):
+            return []
+        return sorted(os.listdir(self.build_folder))
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "params": self.params,
+            "status": self.status,
+            "error": self.error,
+            "artifacts": self.artifacts(),
+        }
+
+
+class CrawlerRequestHandler(BaseHTTPRequestHandler):
+    @property
+    def service(self) -> CrawlerService:
+        return self.server.service
+
+    def send_json(self, status: int, body):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        if urlparse(self.path).path.strip("/") != "jobs":
+            return self.send_json(404, {"error": "Not found"})
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(length) or b"{}")
+            job = self.service.submit(params)
+        except ValueError as ex:
+            return self.send_json(400, {"error": str(ex)})
+
+        self.send_json(202, job.to_dict())
+
+    def do_GET(self):
+        parts = [unquote(part) for part in urlparse(self.path).path.strip("/").split("/")]
+
+        if parts == ["jobs"]:
+            return self.send_json(200, [job.to_dict() for job in self.service.list_jobs()])
+
+        job = self.service.get_job(parts[1]) if len(parts) >= 2 and parts[0] == "jobs" else None
+        if job is None:
+            return self.send_json(404, {"error": "Not found"})
+
+        if len(parts) == 2:
+            return self.send_json(200, job.to_dict())
+
+        if parts[2:] == ["events"]:
+            return self.send_events(job)
+
+        if len(parts) == 4 and parts[2] == "files" and parts[3] in job.artifacts():
+            return self.send_artifact(os.path.join(job.build_folder, parts[3]))
+
+        return self.send_json(404, {"error": "Not found"})
+
+    def send_events(self, job: Job):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        try:
+            for event in job.follow():
+                self.wfile.write(f"event: {event['event']}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped listening; the job carries on regardless
+            pass
+
+    def send_artifact(self, path: str):
+        with open(path, "rb") as f:
+            content = f.read()
+
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")
+        self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    # the notebook only skips its interactive testing overrides when this is set
+    os.environ["PAPERMILL_EXEC"] = "1"
+    # the notebook expects its own folder as the working directory, e.g. to find the CSL styles
+    os.chdir(NOTEBOOKS_FOLDER)
+
+    service = CrawlerService()
+    service.start()
+
+    # listen on every interface within the container, so docker can forward to it;
+    # run_service.sh only publishes the port on the host's loopback interface,
+    # since the service has no authentication
+    server = ThreadingHTTPServer(("0.0.0.0", SERVICE_PORT), CrawlerRequestHandler)
+    server.service = service
+
+    log.info(f"PMC crawler service listening on port {SERVICE_PORT}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,14 @@ mkdir -p /app/_output
 
 TARGET_NOTEBOOK=${TARGET_NOTEBOOK:-"Create Cites from PMC Lookups - Monthly.ipynb"}
 
+# run as a long-lived HTTP service that executes the notebook per request,
+# rather than running the notebook once with papermill (see crawler_service.py)
+if [ "${CRAWLER_MODE}" = "service" ]; then
+    echo "--- Starting the PMC crawler service on port ${CRAWLER_SERVICE_PORT:-8080}"
+    cd /app/notebooks && \
+    exec poetry run python /app/crawler_service.py
+fi
+
 # debugging
 echo "--- Starting the PMC crawler with the following parameters:"
 echo "* START_DATE: ${START_DATE}"
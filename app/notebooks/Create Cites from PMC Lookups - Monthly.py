@@ -24,6 +24,8 @@ import json
 import logging
 import os
 import copy
+import hashlib
+import sqlite3
 import subprocess
 import time
 from dateutil import parser
@@ -61,6 +63,10 @@ NCBI_API_KEY = os.environ.get('NCBI_API_KEY')
 # (Optional) NCBI API email
 NCBI_API_EMAIL = os.environ.get('NCBI_API_EMAIL')
 
+# (Optional) where each run's publications are appended as a Parquet dataset
+# set to an empty string to disable writing to the store
+PUBLICATION_STORE_PATH = os.environ.get("PUBLICATION_STORE_PATH", "/app/_build/publication_store")
+
 # + tags=["parameters"] jupyter={"outputs_hidden": true}
 # Papermill Parameters Cell
 # These can be used as arguments via papermill
@@ -83,6 +89,10 @@ department:str = None
 # the display name of the department, used to customize the report
 department_name:str = None
 
+# set by crawler_service.py when it runs this notebook in-process, so that the roster, caches and
+# CSL style stay warm between report jobs; always None when run by papermill
+crawler_service = None
+
 # + jupyter={"outputs_hidden": true}
 # ==============================================================================
 # === testing overrides
@@ -101,6 +111,7 @@ print(f"Testing in notebook?: {IN_NB_TESTING}")
 if IN_NB_TESTING:
     # enable our own strict filtering of the post-publication dates
     os.environ['POSTFILTER_DATES'] = '1'
+    os.environ['PREFILTER_DATES'] = '1'
     os.environ['NCBI_DATETYPE'] = 'edat'
 
     # the beginning of last month
@@ -112,6 +123,7 @@ if IN_NB_TESTING:
 
     print(f"datetype: {os.environ['NCBI_DATETYPE']}")
     print(f"post-filter dates?: {os.environ['POSTFILTER_DATES']}")
+    print(f"pre-filter dates?: {os.environ['PREFILTER_DATES']}")
     print(f"start_date: {start_date}")
     print(f"end_date: {end_date}")
     print(f"authors_sheet_path: {authors_sheet_path}")
@@ -219,55 +231,71 @@ if not os.path.exists(BUILD_FOLDER):
 # Uses whichever one of `authors_sheet_id` or `authors_sheet_path` is specified to fetch the list of authors. If it's the `_id` version, the sheet is fetched from Smartsheet by its ID, whereas if it's `_path` it's loaded from a local Excel/CSV file. If both are specified, an error is returned.
 
 # + jupyter={"outputs_hidden": true}
-if author_sheet_valid:
-    print(f"Loading authors from local spreadsheet file: {authors_sheet_path}")
-    
-    from pathlib import Path
-    # load up the local file instead
-    pth = Path(authors_sheet_path)
-    authors_df = pd.read_excel(pth)
-    
-elif authors_sheet_id is not None and str(authors_sheet_id).strip() != '' and int(authors_sheet_id) != -1:
-    print(f"Loading authors from Smartsheet by ID: {authors_sheet_id}")
-    
-    # connect smartsheet client
-    ss_client = smartsheet.Smartsheet(os.environ.get("SMARTSHEET_KEY"))
-    ss_client.errors_as_exceptions(True)
-
-    # authors_sheet = ss_client.Reports.get_report(authors_sheet_id)
-    # the above fetched a report, but i have no idea what that is...
-    # we'll fetch the sheet instead using the "alt" ID
-    authors_sheet = ss_client.Sheets.get_sheet(authors_sheet_id)
-
-    # break down the cell IDs into a quick lookup box
-    cell_ids = ["Row ID"]
-    for column in authors_sheet.columns:
-        my_column = column.to_dict()
-        cell_ids.append(my_column["title"] or "NO_TITLE")
-
-    # cell_ids
-
-    # break down the cells into a list of lists for a later dataframe
-    rows_list = []
-    for row in authors_sheet.rows:
-        row_list = [row.id]
-        for cell in row.cells:
-            if cell.display_value:
-                row_list.append(cell.display_value)
-            else:
-                # just in case there's a None in here, use NaN instead
-                if cell.value:
-                    row_list.append(cell.value)
+def load_authors_df(authors_sheet_path: str, authors_sheet_id) -> pd.DataFrame:
+    """
+    Loads the authors from the local spreadsheet at authors_sheet_path if it's
+    given, or otherwise from the Smartsheet sheet with authors_sheet_id.
+    """
+    if authors_sheet_path is not None and authors_sheet_path.strip() != "":
+        print(f"Loading authors from local spreadsheet file: {authors_sheet_path}")
+
+        from pathlib import Path
+        # load up the local file instead
+        pth = Path(authors_sheet_path)
+        authors_df = pd.read_excel(pth)
+
+    elif authors_sheet_id is not None and str(authors_sheet_id).strip() != '' and int(authors_sheet_id) != -1:
+        print(f"Loading authors from Smartsheet by ID: {authors_sheet_id}")
+
+        # connect smartsheet client
+        ss_client = smartsheet.Smartsheet(os.environ.get("SMARTSHEET_KEY"))
+        ss_client.errors_as_exceptions(True)
+
+        # authors_sheet = ss_client.Reports.get_report(authors_sheet_id)
+        # the above fetched a report, but i have no idea what that is...
+        # we'll fetch the sheet instead using the "alt" ID
+        authors_sheet = ss_client.Sheets.get_sheet(authors_sheet_id)
+
+        # break down the cell IDs into a quick lookup box
+        cell_ids = ["Row ID"]
+        for column in authors_sheet.columns:
+            my_column = column.to_dict()
+            cell_ids.append(my_column["title"] or "NO_TITLE")
+
+        # cell_ids
+
+        # break down the cells into a list of lists for a later dataframe
+        rows_list = []
+        for row in authors_sheet.rows:
+            row_list = [row.id]
+            for cell in row.cells:
+                if cell.display_value:
+                    row_list.append(cell.display_value)
                 else:
-                    row_list.append(np.NaN)
+                    # just in case there's a None in here, use NaN instead
+                    if cell.value:
+                        row_list.append(cell.value)
+                    else:
+                        row_list.append(np.NaN)
 
-        rows_list.append(row_list)
-    
-    # put it together as a dataframe
-    authors_df = pd.DataFrame(rows_list, columns=cell_ids)
+            rows_list.append(row_list)
+
+        # put it together as a dataframe
+        authors_df = pd.DataFrame(rows_list, columns=cell_ids)
+
+    else:
+        raise Exception("One of authors_sheet_path or authors_sheet_id must be specified, but neither were provided.")
 
+    return authors_df
+
+
+# + jupyter={"outputs_hidden": true}
+if crawler_service is not None:
+    # the service keeps the roster in memory between jobs; copy it, since the
+    # cells below modify authors_df in place
+    authors_df = crawler_service.roster(load_authors_df, authors_sheet_path, authors_sheet_id).copy()
 else:
-    raise Exception("One of authors_sheet_path or authors_sheet_id must be specified, but neither were provided.")
+    authors_df = load_authors_df(authors_sheet_path, authors_sheet_id)
 
 # + jupyter={"outputs_hidden": true}
 # only want primary
@@ -316,7 +344,11 @@ authors_df['full NCBI search term'] = authors_df.apply(build_search_term, axis=1
 # cache requests to NCBI so these can be accelerated on subsequent runs
 import requests_cache
 
-session = requests_cache.CachedSession('ncbi_authors_cache')
+if crawler_service is not None:
+    # share the service's already-open cache between jobs
+    session = crawler_service.session
+else:
+    session = requests_cache.CachedSession('ncbi_authors_cache')
 
 # if we hit an error, start with the default wait and double it every time we hit an error again for this URL
 backoff = NCBI_CALL_PERIOD
@@ -429,6 +461,13 @@ log.info(
 
 skipped_authors = set()
 
+if crawler_service is not None:
+    # the service splits the window into months and shares each (search term, month)
+    # result with other jobs, including ones running at the same time
+    search = crawler_service.coalesced_search(search_ncbi)
+else:
+    search = search_ncbi
+
 with logging_redirect_tqdm():
     for author, row in tqdm(authors_df.iterrows(), total=authors_df.shape[0]):
         if row['full NCBI search term']:
@@ -439,7 +478,7 @@ with logging_redirect_tqdm():
             continue
 
         log.info(f"Looking up `{author}` using {search_term}")
-        status_code, ids = search_ncbi(
+        status_code, ids = search(
             term=search_term,
             mindate=month_starting_date,
             maxdate=month_ending_date,
@@ -453,6 +492,139 @@ with logging_redirect_tqdm():
                 id_dict[id] = {"authors": []}
             id_dict[id]["authors"].append(author)
 
+# + jupyter={"outputs_hidden": true}
+# the number of publications the searches returned, before any filtering
+searched_num = len(id_dict)
+
+month_start_parts = [int(x) for x in month_starting_date.split("/")]
+month_end_parts = [int(x) for x in month_ending_date.split("/")]
+
+
+def within_date_range(date_parts: List[int]) -> bool:
+    """
+    Returns whether the [year, month, day] date_parts fall between
+    month_starting_date and month_ending_date, inclusive.
+
+    Partial dates are only compared as far as they go, so e.g. [2023] is
+    within 2023/02/01 to 2023/02/28.
+    """
+    return month_start_parts[:len(date_parts)] <= date_parts <= month_end_parts[:len(date_parts)]
+
+
+# -
+
+# ## Pre-filter publication dates
+#
+# NCBI's date matching is loose, so a good share of the publications found above can fall outside the date range. If `PREFILTER_DATES` is 1, we fetch just the print and electronic publication dates for every publication in batched esummary calls, and drop the ones where neither date falls within the range *before* fetching and rendering their full citations. Publications without a usable date are kept; the exact check against the issued date is still left to `POSTFILTER_DATES` below.
+
+# + jupyter={"outputs_hidden": true}
+# esummary takes many ids per request; this is the most NCBI suggests for a GET
+ESUMMARY_BATCH_SIZE = 200
+
+
+@sleep_and_retry
+@limits(calls=NCBI_RATE_LIMIT, period=NCBI_CALL_PERIOD)
+def fetch_esummary_dates(
+    ids: List[str],
+    api_key: str = None,
+    email: str = NCBI_API_EMAIL,
+) -> Dict[str, List[str]]:
+    """
+    Look up the print and electronic publication dates of the given pubmed IDs,
+    as esummary gives them (e.g. "2023 Feb 3", "2023 Jan-Feb", or "").
+
+    Returns a dict of pubmed ID to its dates; IDs are missing if the request failed.
+    """
+    params = {
+        "db": "pubmed",
+        "id": ",".join(ids),
+        "retmode": "json",
+        "tool": "CUAnschutz-Center_for_Health_AI-DEV",
+        "email": email,
+    }
+
+    if api_key:
+        params["api_key"] = api_key
+
+    r = session.get(
+        "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi", params=params
+    )
+
+    if r.status_code != 200:
+        log.error(f"NCBI returned a status code of {r.status_code} for URL: {r.url}; keeping these {len(ids)} publications unfiltered")
+        return {}
+
+    try:
+        result = r.json().get("result", {})
+
+        return {
+            uid: [result[uid].get("pubdate", ""), result[uid].get("epubdate", "")]
+            for uid in result["uids"]
+        }
+    except (ValueError, KeyError, AttributeError, TypeError) as ex:
+        # e.g. an error message returned with a 200, or a body that isn't JSON
+        log.error(f"NCBI returned an unusable response for URL: {r.url}; keeping these {len(ids)} publications unfiltered (Exception: {ex!r})")
+
+        # the session caches every 200, so forget this one; otherwise re-runs
+        # would get the same response back and never filter this batch
+        session.cache.delete(r.cache_key)
+
+        return {}
+
+
+def esummary_date_parts(esummary_date: str) -> List[int]:
+    """
+    Convert an esummary date like "2023 Feb 3" to [2023, 2, 3].
+
+    Only the parts that are given are returned, and ranges are left off so
+    that nothing in the range is excluded, so "2023 Jan-Feb" is [2023],
+    "2023 Winter" is [2023], and "" is [].
+    """
+    month_numbers = {abbr: number for number, abbr in enumerate(calendar.month_abbr) if abbr}
+
+    date_parts = []
+    for token in esummary_date.split()[:3]:
+        if "-" in token:
+            break
+        elif len(date_parts) == 1 and token[:3] in month_numbers:
+            date_parts.append(month_numbers[token[:3]])
+        elif len(date_parts) != 1 and token.isdigit():
+            date_parts.append(int(token))
+        else:
+            break
+
+    return date_parts
+
+
+# + jupyter={"outputs_hidden": true}
+prefilter_removed = 0
+
+if os.environ.get("PREFILTER_DATES") == "1":
+    print(f"Pre-filtering out publications that don't fall within the date range {month_starting_date} to {month_ending_date}")
+
+    pmids = list(id_dict.keys())
+
+    with logging_redirect_tqdm():
+        for batch_start in tqdm(range(0, len(pmids), ESUMMARY_BATCH_SIZE)):
+            batch = pmids[batch_start:batch_start + ESUMMARY_BATCH_SIZE]
+
+            if crawler_service is not None:
+                # take our turn with the other jobs' NCBI requests
+                esummary_dates = crawler_service.call_ncbi(fetch_esummary_dates, ids=batch, api_key=NCBI_API_KEY)
+            else:
+                esummary_dates = fetch_esummary_dates(batch, api_key=NCBI_API_KEY)
+
+            for key, dates in esummary_dates.items():
+                dates_parts = [esummary_date_parts(x) for x in dates]
+                dates_parts = [x for x in dates_parts if x]
+
+                if dates_parts and not any(within_date_range(x) for x in dates_parts):
+                    print(f"Removing {key} from the list with publication dates {' / '.join(x for x in dates if x)}")
+                    del id_dict[key]
+                    prefilter_removed += 1
+
+    print(f"Removed {prefilter_removed}/{searched_num} publications that didn't fall within the date range before fetching their citations.")
+
 # + jupyter={"outputs_hidden": true}
 # create a list of pubmed ids and fetch the citation json...
 # takes a good bit of time with a large list.
@@ -464,7 +636,11 @@ ids = [f"pubmed:{id}" for id in id_dict.keys()]
 citations = Citations(ids, prune_csl_items=False)
 
 print("Built citations, running get_csl_items...")
-cites = citations.get_csl_items()
+if crawler_service is not None:
+    # only fetch the items the service doesn't already have in memory
+    cites = crawler_service.csl_items(ids, lambda missing: Citations(missing, prune_csl_items=False).get_csl_items())
+else:
+    cites = citations.get_csl_items()
 # cites
 
 # + jupyter={"outputs_hidden": true}
@@ -525,32 +701,24 @@ len([x for x in old_id_dict.values() if "asd" not in x])
 
 id_dict = copy.deepcopy(old_id_dict)
 
+postfilter_removed = 0
+
 if os.environ.get("POSTFILTER_DATES") == "1":
     print(f"Filtering out publications that don't fall within the date range {month_starting_date} to {month_ending_date}")
-    removed = 0
     original_num = len(id_dict)
 
-    month_start_parts = [int(x) for x in month_starting_date.split("/")]
-    month_end_parts = [int(x) for x in month_ending_date.split("/")]
-
     for key in list(id_dict.keys()):
         try:
-            # perform a pairwise comparison of the date parts in id_dict[key]["issued"]["date_parts"] vs. month_start_parts
-            # and month_end_parts
-            compare_start_parts = zip([int(x) for x in id_dict[key]["issued_date"].split("/")], month_start_parts)
-            compare_end_parts = zip([int(x) for x in id_dict[key]["issued_date"].split("/")], month_end_parts)
-
-            # if the year is less than the starting year, or greater than the ending year, remove it
-            if any([issued < month_start for issued, month_start in compare_start_parts]) or \
-                any([issued > month_end for issued, month_end in compare_end_parts]):
+            # compare the date parts in id_dict[key]["issued_date"] against the range, as far as they're given
+            if not within_date_range([int(x) for x in id_dict[key]["issued_date"].split("/")]):
                 print(f"Removing {key} from the list with issued date {id_dict[key]['issued_date']}")
                 del id_dict[key]
-                removed += 1 
+                postfilter_removed += 1
 
         except KeyError as ex:
             print(f"Entry {key} has no issued date, skipping... (Exception: {ex})")
-    
-    print(f"Removed {removed}/{original_num} publications that didn't fall within the date range.")
+
+    print(f"Removed {postfilter_removed}/{original_num} publications that didn't fall within the date range.")
 
 # + jupyter={"outputs_hidden": true}
 # sort the dictionary
@@ -576,7 +744,12 @@ author_info_df = authors_df.merge(author_counts_df, how="inner", left_index=True
 # + jupyter={"outputs_hidden": true}
 # load the citation style
 # (we presume here that the folder with the notebook is the current working directory)
-bib_style = CitationStylesStyle("manubot-style-title-case.csl")
+CSL_STYLE_PATH = "manubot-style-title-case.csl"
+
+if crawler_service is not None:
+    bib_style = crawler_service.style(CSL_STYLE_PATH)
+else:
+    bib_style = CitationStylesStyle(CSL_STYLE_PATH)
 # bib_style
 
 # + jupyter={"outputs_hidden": true}
@@ -603,20 +776,44 @@ def create_bibliography(cites: List):
 
 
 # + jupyter={"outputs_hidden": true}
-# run through the cites one at a time
-cite_markdown = []
-for cite in cites:
-    new_dict = {"PMID": cite["PMID"]}
+# cache rendered citations between runs, since most of a department's cites
+# are the same from month to month. entries are keyed by the CSL item and the
+# contents of the style, so editing the style file invalidates them all.
+citation_cache = sqlite3.connect("rendered_citations_cache.sqlite")
+citation_cache.execute(
+    "CREATE TABLE IF NOT EXISTS citations (key TEXT PRIMARY KEY, html TEXT, markdown TEXT)"
+)
 
-    # I'm only handing them in one at a time
-    result = create_bibliography([cite])
-    new_dict["markdown"] = str(result[0])
+with open(CSL_STYLE_PATH, "rb") as f:
+    style_hash = hashlib.sha256(f.read()).hexdigest()
 
-    cite_markdown.append(new_dict)
 
-# create a df for merging
-cite_markdown_df = pd.DataFrame(cite_markdown).set_index("PMID")
-# cite_markdown_df
+def citation_cache_key(cite: Dict) -> str:
+    """
+    Returns the key under which the rendered citation for cite is cached.
+    """
+    cite_json = json.dumps(cite, sort_keys=True)
+    return hashlib.sha256(f"{style_hash}:{cite_json}".encode("utf-8")).hexdigest()
+
+
+# + jupyter={"outputs_hidden": true}
+# run through the cites one at a time, only rendering the ones that aren't in the cache
+cached_markdown = []
+new_markdown = []
+for cite in cites:
+    key = citation_cache_key(cite)
+    cached = citation_cache.execute(
+        "SELECT html, markdown FROM citations WHERE key = ?", (key,)
+    ).fetchone()
+
+    if cached:
+        cached_markdown.append({"PMID": cite["PMID"], "html": cached[0], "markdown": cached[1]})
+    else:
+        # I'm only handing them in one at a time
+        result = create_bibliography([cite])
+        new_markdown.append({"PMID": cite["PMID"], "key": key, "html": str(result[0]), "markdown": str(result[0])})
+
+print(f"Rendered {len(new_markdown)} citations, reused {len(cached_markdown)} from the cache.")
 
 # + jupyter={"outputs_hidden": true}
 # manubot gives out HTML, and <i> is interpreted correctly,
@@ -633,7 +830,25 @@ def markdown_me(row):
     return row
 
 
-cite_markdown_df = cite_markdown_df.apply(markdown_me, axis=1)
+if new_markdown:
+    new_markdown_df = pd.DataFrame(new_markdown).apply(markdown_me, axis=1)
+
+    citation_cache.executemany(
+        "INSERT OR REPLACE INTO citations (key, html, markdown) VALUES (?, ?, ?)",
+        new_markdown_df[["key", "html", "markdown"]].itertuples(index=False),
+    )
+    citation_cache.commit()
+else:
+    new_markdown_df = pd.DataFrame(columns=["PMID", "html", "markdown"])
+
+citation_cache.close()
+
+# create a df for merging
+cite_markdown_df = (
+    pd.concat([pd.DataFrame(cached_markdown, columns=["PMID", "html", "markdown"]), new_markdown_df])
+    .set_index("PMID")[["html", "markdown"]]
+)
+# cite_markdown_df
 
 # + jupyter={"outputs_hidden": true}
 # and finally a reporting DF
@@ -652,6 +867,68 @@ with open(out_sheet, "wb") as f:
     log.info(f"Wrote out {out_sheet}\n")
 # -
 
+# ## Add to the Publication Store
+#
+# Appends this run's publications to a Parquet dataset at `PUBLICATION_STORE_PATH`, partitioned by the month in which each item was issued and by the author's "Primary Department". There's one row per publication and author, so annual or multi-year reports and per-author counts can be built from the store by the "Create Report from Publication Store" notebook without crawling NCBI again.
+
+# + jupyter={"outputs_hidden": true}
+def publication_month(issued_date) -> str:
+    """
+    Returns the month (as yyyy-mm) under which an item is filed in the store.
+
+    Items whose issued date only has a year are filed under month "00" of that
+    year (e.g. "2023-00"), which the report reads for every year it covers.
+    Items without an issued date are filed under the month in which the crawl
+    ended.
+    """
+    if isinstance(issued_date, str) and issued_date.strip() != "":
+        date_parts = issued_date.split("/") + ["0"]
+    else:
+        date_parts = month_ending_date.split("/")
+
+    return f"{int(date_parts[0]):04d}-{int(date_parts[1]):02d}"
+
+
+# + jupyter={"outputs_hidden": true}
+if PUBLICATION_STORE_PATH and not report_df.empty:
+    store_df = (
+        report_df.reindex(columns=["authors", "title", "issued_date", "markdown"])
+        .explode("authors")
+        .rename(columns={"authors": "author", "markdown": "citation"})
+        .rename_axis("pmid")
+        .reset_index()
+    )
+    store_df["issued_date"] = store_df["issued_date"].where(store_df["issued_date"].notna(), None)
+
+    # attribute each author to their own department, so that a crawl over
+    # every author can later be reported on per-department
+    if "Primary Department" in authors_df.columns:
+        author_departments = authors_df["Primary Department"].groupby(level=0).first()
+        store_df["department"] = store_df["author"].map(author_departments)
+    else:
+        store_df["department"] = None
+    store_df["department"] = store_df["department"].fillna("").astype(str).str.strip().replace("", "unassigned")
+
+    store_df["month"] = store_df["issued_date"].apply(publication_month)
+    store_df["crawl_start_date"] = month_starting_date
+    store_df["crawl_end_date"] = month_ending_date
+    store_df["crawled_at"] = datetime.now().isoformat(timespec="seconds")
+
+    # store every column as a string, so that each run's files have the same
+    # schema even when e.g. none of its items have an issued date
+    store_df = store_df.astype("string")
+
+    # each run adds new files to the partitions it touches; overlapping runs
+    # are resolved when reading by keeping the most recent crawl of each row
+    store_df.to_parquet(
+        PUBLICATION_STORE_PATH,
+        engine="pyarrow",
+        partition_cols=["month", "department"],
+        index=False,
+    )
+    log.info(f"Added {len(store_df)} publication/author rows to the store at {PUBLICATION_STORE_PATH}\n")
+# -
+
 # ## Build up the markdown
 
 # + jupyter={"outputs_hidden": true}
@@ -683,6 +960,15 @@ with open(
             f"|{index}|{row['NCBI search term']}|{row['ORCID number']}|{row['title count']}\n"
         )
 
+    if os.environ.get("PREFILTER_DATES") == "1" or os.environ.get("POSTFILTER_DATES") == "1":
+        f.write(f"\n## Publications Considered\n\n")
+        f.write(f"- {searched_num} found by the NCBI searches\n")
+        if os.environ.get("PREFILTER_DATES") == "1":
+            f.write(f"- {prefilter_removed} discarded by publication date, before fetching citations\n")
+        if os.environ.get("POSTFILTER_DATES") == "1":
+            f.write(f"- {postfilter_removed} discarded by issued date, after fetching citations\n")
+        f.write(f"- {len(report_df)} included in this report\n\n")
+
     if skipped_authors:
         f.write(f"## Skipped Searches\n\n")
         f.write(f"The following authors have been skipped due to a missing NCBI search term and missing ORCID.\n\n")
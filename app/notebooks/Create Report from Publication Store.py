@@ -0,0 +1,251 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:light
+#     text_representation:
+#       extension: .py
+#       format_name: light
+#       format_version: '1.5'
+#       jupytext_version: 1.16.1
+#   kernelspec:
+#     display_name: Python 3 (ipykernel)
+#     language: python
+#     name: python3
+# ---
+
+# # Report from the Publication Store
+#
+# This builds the same markdown, Excel, PDF, and MS Word documents as the monthly crawl, but for any date range and department, using only the publications that previous crawls have added to the Parquet store at `PUBLICATION_STORE_PATH`. No requests are made to NCBI, so fiscal-year or multi-year reports take seconds rather than requiring a crawl over the whole range.
+#
+# Only publications that were crawled at some point are present in the store, so a report over a range that was never crawled (or was crawled for a different department) will be incomplete.
+
+# + jupyter={"outputs_hidden": true}
+import sys
+import logging
+import os
+from datetime import datetime
+from typing import List
+import pandas as pd
+import requests
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG, stream=sys.stdout, force=True)
+
+# + jupyter={"outputs_hidden": true}
+# set variables from the environment
+BUILD_FOLDER_PREFIX = os.environ.get("BUILD_FOLDER_PREFIX", "/app/_build")
+
+# the Parquet dataset that the monthly crawl appends to
+PUBLICATION_STORE_PATH = os.environ.get("PUBLICATION_STORE_PATH", "/app/_build/publication_store")
+
+# + tags=["parameters"] jupyter={"outputs_hidden": true}
+# Papermill Parameters Cell
+# These can be used as arguments via papermill
+
+# the dates (as string in the format yyyy/mm/dd) between which to report, inclusive
+start_date: str = "2023/07/01"
+end_date: str = "2024/06/30"
+
+# the name of the department by which to filter authors, i.e. the value on which to match against the "Primary Department" column
+# if null or blank, disables filtering by department
+department:str = None
+
+# the display name of the department, used to customize the report
+department_name:str = None
+
+# + jupyter={"outputs_hidden": true}
+assert start_date and end_date, "Both start_date and end_date are required to report from the store"
+assert os.path.exists(PUBLICATION_STORE_PATH), f"No publication store found at {PUBLICATION_STORE_PATH}"
+
+prepared_date = datetime.today().strftime("%Y/%m/%d")
+
+BUILD_MARKDOWN_FILEROOT = f"cites_report-{start_date.replace('/','-')}_to_{end_date.replace('/','-')}"
+BUILD_MARKDOWN_FILENAME = f"{BUILD_MARKDOWN_FILEROOT}.md"
+BUILD_SHEET_FILENAME = f"{BUILD_MARKDOWN_FILEROOT}.xlsx"
+BUILD_PDF_FILENAME = f"{BUILD_MARKDOWN_FILEROOT}.pdf"
+BUILD_DOCX_FILENAME = f"{BUILD_MARKDOWN_FILEROOT}.docx"
+
+# ensure the output folder exists, and group the results of this run into a folder created from the start and end date
+BUILD_FOLDER = os.path.join(BUILD_FOLDER_PREFIX, f"{start_date}_to_{end_date}".replace("/", "-"))
+
+# will write out to a folder
+if not os.path.exists(BUILD_FOLDER):
+    os.makedirs(BUILD_FOLDER)
+
+
+# + jupyter={"outputs_hidden": true}
+def months_between(start: str, end: str) -> List[str]:
+    """
+    Returns every month (as yyyy-mm, matching the store's "month" partitions)
+    from the month of start through the month of end, inclusive, plus the
+    "yyyy-00" partition of each year, where items with only an issued year are filed.
+    """
+    start_year, start_month = [int(x) for x in start.split("/")[:2]]
+    end_year, end_month = [int(x) for x in end.split("/")[:2]]
+
+    months = [f"{year:04d}-00" for year in range(start_year, end_year + 1)]
+    year, month = start_year, start_month
+    while (year, month) <= (end_year, end_month):
+        months.append(f"{year:04d}-{month:02d}")
+        month += 1
+        if month == 13:
+            month = 1
+            year += 1
+
+    return months
+
+
+# + jupyter={"outputs_hidden": true}
+# read just the partitions for the requested months (and department, if any)
+filters = [("month", "in", months_between(start_date, end_date))]
+if department and department.strip() != "":
+    filters.append(("department", "=", department))
+
+store_df = pd.read_parquet(PUBLICATION_STORE_PATH, engine="pyarrow", filters=filters)
+store_df["month"] = store_df["month"].astype(str)
+store_df["department"] = store_df["department"].astype(str)
+
+# the same publication may have been crawled more than once, e.g. by a monthly
+# run and a re-run of that month; keep the most recent crawl of each
+store_df = (
+    store_df.sort_values(by="crawled_at")
+    .drop_duplicates(subset=["pmid", "author"], keep="last")
+)
+
+print(f"Read {len(store_df)} publication/author rows from {PUBLICATION_STORE_PATH}")
+
+# +
+# the month partitions are coarser than the requested dates, so filter the
+# issued dates to the exact range using the same comparison as the crawl's
+# POSTFILTER_DATES step
+start_parts = [int(x) for x in start_date.split("/")]
+end_parts = [int(x) for x in end_date.split("/")]
+
+
+def issued_within_range(issued_date) -> bool:
+    if not isinstance(issued_date, str) or issued_date.strip() == "":
+        # items without an issued date were filed under the month their crawl
+        # ended, so they're included whenever that month is read
+        return True
+
+    # partial dates are only compared as far as they go, so e.g. an item issued
+    # in "2023" is included in any report that overlaps 2023
+    issued_parts = [int(x) for x in issued_date.split("/")]
+
+    return start_parts[:len(issued_parts)] <= issued_parts <= end_parts[:len(issued_parts)]
+
+
+original_num = len(store_df)
+store_df = store_df[store_df["issued_date"].apply(issued_within_range)]
+
+print(f"Removed {original_num - len(store_df)}/{original_num} rows that didn't fall within the date range {start_date} to {end_date}")
+
+# + jupyter={"outputs_hidden": true}
+# collapse the publication/author rows back down to one row per publication
+report_df = (
+    store_df.groupby("pmid")
+    .agg(
+        authors=("author", lambda x: sorted(set(x))),
+        title=("title", "first"),
+        issued_date=("issued_date", "first"),
+        markdown=("citation", "first"),
+    )
+    .sort_values(by="title")
+)
+
+# report_df
+
+# + jupyter={"outputs_hidden": true}
+# get the counts by author
+author_counts_df = (
+    store_df.groupby(["author", "department"])["pmid"]
+    .nunique()
+    .to_frame()
+    .rename(columns={"pmid": "title count"})
+    .reset_index("department")
+)
+
+author_counts_df
+# -
+
+# ## Write out Summary Spreadsheet
+
+# + jupyter={"outputs_hidden": true}
+# write out the report dataframe to a spreadsheet
+out_sheet = os.path.join(BUILD_FOLDER, BUILD_SHEET_FILENAME)
+with open(out_sheet, "wb") as f:
+    publication_df = report_df[["authors", "title", "issued_date"]]
+    publication_df.to_excel(f)
+    log.info(f"Wrote out {out_sheet}\n")
+# -
+
+# ## Build up the markdown
+
+# + jupyter={"outputs_hidden": true}
+log.info(f"Writing file {BUILD_MARKDOWN_FILENAME} to {BUILD_FOLDER}")
+with open(
+    os.path.join(BUILD_FOLDER, BUILD_MARKDOWN_FILENAME), "w", encoding="utf-8"
+) as f:
+    if department_name is not None and str(department_name).strip() != "":
+        f.write(f"# {department_name}\n\n")
+
+    f.write(f"## Published Items Bibliography\n\n")
+    f.write(f"For the period {start_date} to {end_date}\n\n")
+
+    for index, row in report_df.iterrows():
+        f.write(f"{row['markdown']}\n\n")
+        for author in row["authors"]:
+            f.write(f" &mdash; <cite>{author}</cite>\n\n")
+        f.write("***\n")
+
+    f.write(f"## Authors\n\n")
+
+    f.write(f"|Author|Department|Title Count\n")
+    f.write(f"|---|---|---\n")
+    for index, row in author_counts_df.iterrows():
+        f.write(
+            f"|{index}|{row['department']}|{row['title count']}\n"
+        )
+
+    f.write("\n")
+    f.write(f"Generated {prepared_date} from the publication store\n")
+# -
+
+# ## Convert markdown to pdf and docx
+#
+# Uses the same reformed container as the monthly crawl; see that notebook for details.
+
+# + jupyter={"outputs_hidden": true}
+REFORMED_API_URL = "http://reformed:8000" # changed 'reformed' to localhost if you're accessing it from the host
+
+
+# + jupyter={"outputs_hidden": true}
+def convert(input_path, input_fmt, output_path, output_fmt):
+    url = f"{REFORMED_API_URL}/api/v1/from/{input_fmt}/to/{output_fmt}"
+
+    try:
+        with open(input_path, "rb") as f:
+            r = requests.post(url, files={"document": f.read()})
+
+        if r.status_code == 200:
+            with open(output_path, "wb") as f:
+                f.write(r.content)
+        else:
+            raise Exception(f"Non-200 response, code {r.status_code}")
+
+        print(f"Read in {input_path}, outputted to {output_path}")
+    except Exception as ex:
+        print(ex)
+
+
+# + jupyter={"outputs_hidden": true}
+convert(
+    input_path = os.path.join(BUILD_FOLDER, BUILD_MARKDOWN_FILENAME), input_fmt="markdown",
+    output_path = os.path.join(BUILD_FOLDER, BUILD_PDF_FILENAME), output_fmt="pdf"
+)
+
+# + jupyter={"outputs_hidden": true}
+convert(
+    input_path = os.path.join(BUILD_FOLDER, BUILD_MARKDOWN_FILENAME), input_fmt="markdown",
+    output_path = os.path.join(BUILD_FOLDER, BUILD_DOCX_FILENAME), output_fmt="docx"
+)
@@ -165,8 +165,10 @@ time (
         -e DEPARTMENT="${DEPARTMENT}" \
         -e DEPARTMENT_NAME="${DEPARTMENT_NAME:-''}" \
         -e BUILD_FOLDER_PREFIX="${BUILD_FOLDER_PREFIX:-/app/_build}" \
+        -e PUBLICATION_STORE_PATH="${PUBLICATION_STORE_PATH-/app/_build/publication_store}" \
         -e NCBI_DATETYPE="${NCBI_DATETYPE:-"DEFAULT"}" \
         -e POSTFILTER_DATES="${POSTFILTER_DATES:-"0"}" \
+        -e PREFILTER_DATES="${PREFILTER_DATES:-"0"}" \
         -e PAPERMILL_EXEC=1 \
         -v $PWD/app:/app \
         -v $PWD/output:/app/_build \
@@ -0,0 +1,119 @@
+#!/usr/bin/env bash
+
+# builds a report for any date range and department from the publication store
+# that run_crawl.sh appends to, without querying NCBI again
+
+# exit on any error
+set -e
+
+# allow the user to enable verbose output with an env var
+VERBOSE=${VERBOSE:-0}
+
+# create a network in which to run the PMC crawler and reformed
+DOCKER_NETWORK="pmc-crawler"
+
+# which docker image to use to run the report (see run_crawl.sh)
+CRAWLER_IMAGE=${CRAWLER_IMAGE:-"us-central1-docker.pkg.dev/cuhealthai-foundations/tools/pmc-crawler:latest"}
+
+function echo_verbose {
+    if [[ ${VERBOSE} -eq 1 ]]; then
+        echo "$@"
+    fi
+}
+
+# create the network for the pmc crawler and reformed, if it doesn't already exist
+docker network create pmc-crawler 2>/dev/null || \
+    echo_verbose "* Network '${DOCKER_NETWORK}' already exists, skipping creation..."
+
+# ensure the format converter container is running
+if ! ( docker ps | grep reformed >/dev/null 2>&1 ); then
+    echo_verbose "* Reformed isn't running, booting it now..."
+    docker run --rm -d \
+        --name reformed \
+        --network ${DOCKER_NETWORK} \
+        -p 8088:8000 \
+        ghcr.io/davidlougheed/reformed:sha-1b8f46b
+fi
+
+# where the store is inside the container, defaulting to the same place as run_crawl.sh
+PUBLICATION_STORE_PATH=${PUBLICATION_STORE_PATH-/app/_build/publication_store}
+
+# find the store on the host through the folders mounted into the container
+case "${PUBLICATION_STORE_PATH}" in
+    /app/_build/*) HOST_STORE_PATH="./output/${PUBLICATION_STORE_PATH#/app/_build/}" ;;
+    /app/*) HOST_STORE_PATH="./app/${PUBLICATION_STORE_PATH#/app/}" ;;
+    *)
+        echo "ERROR: PUBLICATION_STORE_PATH must be under /app or /app/_build, which are mounted from ./app and ./output"
+        exit 1
+        ;;
+esac
+
+if [ ! -d "${HOST_STORE_PATH}" ]; then
+    echo "ERROR: no publication store found at ${HOST_STORE_PATH}; run ./run_crawl.sh first"
+    exit 1
+fi
+
+# ---------------------------------------
+# --- step 1. prompt for run parameters
+# ---------------------------------------
+
+# pre-step: extract params from the .env file, if available
+ENV_FILE="./app/.env"
+if [ -f "${ENV_FILE}" ]; then
+    ENV_DEPARTMENT=$( cat ${ENV_FILE} | grep -e '^DEPARTMENT=' | cut -d'=' -f2 )
+    ENV_DEPARTMENT_NAME=$( cat ${ENV_FILE} | grep -e '^DEPARTMENT_NAME=' | cut -d'=' -f2 )
+fi
+
+DEPARTMENT=${DEPARTMENT:-${ENV_DEPARTMENT:-""}}
+DEPARTMENT_NAME=${DEPARTMENT_NAME:-${ENV_DEPARTMENT_NAME:-""}}
+
+if [ -z "${START_DATE}" ]; then
+    read -p "- Enter start date (YYYY/MM/DD): " START_DATE
+fi
+
+if [ -z "${END_DATE}" ]; then
+    read -p "- Enter end date (YYYY/MM/DD): " END_DATE
+fi
+
+if [ -z "${START_DATE}" ] || [ -z "${END_DATE}" ]; then
+    echo "ERROR: both a start date and an end date are required"
+    exit 1
+fi
+
+if [ ! ${DEPARTMENT+x} ]; then
+    read -p "- Enter department (a blank value disables this filter): " INPUT_DEPARTMENT
+    DEPARTMENT=${INPUT_DEPARTMENT:-""}
+fi
+
+if [ -z "${DEPARTMENT_NAME}" ]; then
+    read -p "- Enter department name, for customizing the report: " INPUT_DEPARTMENT_NAME
+    DEPARTMENT_NAME=${INPUT_DEPARTMENT_NAME:-""}
+fi
+
+# -------------------------------------------------------------------
+# --- step 2. build the report, storing artifacts in ./output
+# -------------------------------------------------------------------
+
+# where the notebook w/evaluated cells will be saved
+mkdir -p intermediate
+
+# clean up any old containers before running
+docker rm --force pmc-crawler >/dev/null 2>&1
+
+time (
+    docker run --init -it --name pmc-crawler \
+        --network ${DOCKER_NETWORK} \
+        -e START_DATE="${START_DATE}" \
+        -e END_DATE="${END_DATE}" \
+        -e DEPARTMENT="${DEPARTMENT}" \
+        -e DEPARTMENT_NAME="${DEPARTMENT_NAME:-''}" \
+        -e BUILD_FOLDER_PREFIX="${BUILD_FOLDER_PREFIX:-/app/_build}" \
+        -e PUBLICATION_STORE_PATH="${PUBLICATION_STORE_PATH}" \
+        -e TARGET_NOTEBOOK="Create Report from Publication Store.ipynb" \
+        -e PAPERMILL_EXEC=1 \
+        -v $PWD/app:/app \
+        -v $PWD/output:/app/_build \
+        -v $PWD/intermediate:/app/_output \
+        --env-file ./app/.env \
+        ${CRAWLER_IMAGE}
+)
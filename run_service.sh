@@ -0,0 +1,69 @@
+#!/usr/bin/env bash
+
+# starts the crawler as a long-lived HTTP service (see app/crawler_service.py),
+# which keeps its caches warm between report requests
+
+# exit on any error
+set -e
+
+# allow the user to enable verbose output with an env var
+VERBOSE=${VERBOSE:-0}
+
+# create a network in which to run the PMC crawler and reformed
+DOCKER_NETWORK="pmc-crawler"
+
+# which docker image to use to run the service (see run_crawl.sh)
+CRAWLER_IMAGE=${CRAWLER_IMAGE:-"us-central1-docker.pkg.dev/cuhealthai-foundations/tools/pmc-crawler:latest"}
+
+# the port on the host at which the service will listen
+CRAWLER_SERVICE_PORT=${CRAWLER_SERVICE_PORT:-8080}
+
+function echo_verbose {
+    if [[ ${VERBOSE} -eq 1 ]]; then
+        echo "$@"
+    fi
+}
+
+# create the network for the pmc crawler and reformed, if it doesn't already exist
+docker network create pmc-crawler 2>/dev/null || \
+    echo_verbose "* Network '${DOCKER_NETWORK}' already exists, skipping creation..."
+
+# ensure the format converter container is running
+if ! ( docker ps | grep reformed >/dev/null 2>&1 ); then
+    echo_verbose "* Reformed isn't running, booting it now..."
+    docker run --rm -d \
+        --name reformed \
+        --network ${DOCKER_NETWORK} \
+        -p 8088:8000 \
+        ghcr.io/davidlougheed/reformed:sha-1b8f46b
+fi
+
+# author sheets given to jobs as authors_sheet_path should be placed here,
+# and referred to as /app/input_sheets/<filename>
+mkdir -p ./app/input_sheets
+
+# where the reports are stored, under a folder per job
+mkdir -p output
+
+# clean up any old service container before running
+docker rm --force pmc-crawler-service >/dev/null 2>&1
+
+docker run --init -d --name pmc-crawler-service \
+    --network ${DOCKER_NETWORK} \
+    -p 127.0.0.1:${CRAWLER_SERVICE_PORT}:8080 \
+    -e CRAWLER_MODE=service \
+    -e BUILD_FOLDER_PREFIX="/app/_build" \
+    -e PUBLICATION_STORE_PATH="${PUBLICATION_STORE_PATH-/app/_build/publication_store}" \
+    -e NCBI_DATETYPE="${NCBI_DATETYPE:-"DEFAULT"}" \
+    -e POSTFILTER_DATES="${POSTFILTER_DATES:-"0"}" \
+    -e PREFILTER_DATES="${PREFILTER_DATES:-"0"}" \
+    -e CRAWLER_SERVICE_WORKERS="${CRAWLER_SERVICE_WORKERS:-2}" \
+    -e CRAWLER_SERVICE_CACHE_TTL="${CRAWLER_SERVICE_CACHE_TTL:-21600}" \
+    -e CRAWLER_SERVICE_JOB_HISTORY="${CRAWLER_SERVICE_JOB_HISTORY:-100}" \
+    -v $PWD/app:/app \
+    -v $PWD/output:/app/_build \
+    --env-file ./app/.env \
+    ${CRAWLER_IMAGE}
+
+echo "* PMC crawler service started at http://localhost:${CRAWLER_SERVICE_PORT}"
+echo "* (view its logs with 'docker logs -f pmc-crawler-service', stop it with 'docker rm -f pmc-crawler-service')"